@@ -68,6 +68,7 @@ fi
 # ── Verify prerequisites ──────────────────────────────────
 [ -x "$VENV_PYTHON" ] || { echo "✗ venv python not found at $VENV_PYTHON"; exit 1; }
 $VENV_PYTHON -c "import fontTools" 2>/dev/null || { echo "✗ fonttools not installed in venv"; exit 1; }
+$VENV_PYTHON -c "import uharfbuzz" 2>/dev/null || { echo "✗ uharfbuzz not installed in venv"; exit 1; }
 echo "✓ Prerequisites verified"
 echo ""
 
@@ -132,7 +133,10 @@ FONT_VERSION="$(date +%s)"
 echo "── Stamping font version: $FONT_VERSION ──"
 sed -i "s/__FONT_VERSION__/$FONT_VERSION/g" src/styles/global.css
 sed -i "s/__FONT_VERSION__/$FONT_VERSION/g" src/layouts/BaseLayout.astro
-echo "  ✓ Replaced __FONT_VERSION__ in global.css and BaseLayout.astro"
+# subsets.css survives between deploys when subset-fonts.py reuses its cache,
+# so also overwrite a previous stamp, not just the placeholder
+sed -i -E "s/\?v=(__FONT_VERSION__|[0-9]+)/?v=$FONT_VERSION/g" public/fonts/subsets.css
+echo "  ✓ Replaced __FONT_VERSION__ in global.css, BaseLayout.astro and subsets.css"
 echo ""
 
 # ── Build ─────────────────────────────────────────────────
@@ -15,13 +15,20 @@ Only the three weights actually used by CSS are generated:
 Usage:
     python3 subset-fonts.py <content_dir> <output_dir>
 
-Requires: fonttools, brotli (pip install fonttools brotli)
+Requires: uharfbuzz, fonttools, brotli (pip install uharfbuzz fonttools brotli)
+  uharfbuzz (hb-subset) does the subsetting; fonttools handles coverage
+  checks and woff2 wrapping.
 Source fonts: /opt/palimpsestus/fonts/NotoSerifCJKsc-*.otf
 """
 
 import sys
 import os
+import io
 import glob
+import json
+import hashlib
+import heapq
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 FONT_DIR = "/opt/palimpsestus/fonts"
 
@@ -47,65 +54,190 @@ ALWAYS_INCLUDE = set(
     "✉·›"
 )
 
+# hb-subset plan shared by every weight and every worker (build_subset_input).
+# Keep basic layout features for proper rendering.
+SUBSET_LAYOUT_FEATURES = ["kern", "liga", "calt", "ccmp", "locl"]
+# The site is set horizontally: vertical metrics and baseline/justification
+# tables are never consulted, so hb-subset never has to walk them.
+SUBSET_DROP_TABLES = ["meta", "MATH", "FFTM", "BASE", "JSTF",
+                      "vhea", "vmtx", "VORG"]
+
+# C0 control codepoints (tab, newline, ...) never need glyphs
+_CONTROL_CPS = frozenset(range(0x20))
+
+# ALWAYS_INCLUDE as clean codepoints, computed once at import
+_ALWAYS_INCLUDE_CPS = frozenset(map(ord, ALWAYS_INCLUDE)) - _CONTROL_CPS
+
 # Output font-family name used in CSS
 FAMILY = "SiteSerif"
 
+# Build cache, kept outside the output dir so it never lands in public/ and
+# gets deployed: <repo>/.cache/subset-fonts (git-ignored, survives deploys)
+CACHE_DIR = os.path.normpath(os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), os.pardir, ".cache",
+    "subset-fonts"))
+MANIFEST = "manifest.json"
+
+# @font-face rules for the generated subsets, linked from BaseLayout.astro
+FONT_FACE_CSS = "subsets.css"
+
+# Longest run of unused codepoints merged into one unicode-range span
+_RANGE_MAX_GAP = 0xFF
+
+
+def _walk_content(root: str):
+    """Yield MDX/MD file paths under root (os.scandir walk, no per-file stat).
+
+    Matches the recursive glob it replaced, and Astro's content loader:
+    dot-files and dot-dirs are skipped, symlinked dirs are followed.
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.name.startswith("."):
+                continue
+            if entry.is_dir():
+                yield from _walk_content(entry.path)
+            elif entry.name.endswith((".mdx", ".md")):
+                yield entry.path
 
-def scan_content(content_dir: str) -> set[str]:
-    """Scan all MDX/MD files and collect every unique character."""
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _read_files(paths: list[str]):
+    """Yield each file's bytes in order, with reads overlapped on threads.
+
+    read() releases the GIL, so the caller's decode/hash work on one file
+    runs while the next ones are still coming off disk.
+    """
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        yield from pool.map(_read_bytes, paths)
+
+
+def scan_content(content_dir: str) -> tuple[set[int], str]:
+    """Scan all MDX/MD files and collect every unique codepoint.
+
+    Also returns a hash of the content (relative paths + bytes), computed
+    from the same reads, for the build cache.
+    """
     chars = set()
+    h = hashlib.blake2b()
 
-    patterns = ["**/*.mdx", "**/*.md"]
-    files = []
-    for pat in patterns:
-        files.extend(glob.glob(os.path.join(content_dir, pat), recursive=True))
+    files = sorted(_walk_content(content_dir))
 
     if not files:
         print(f"  Warning: no content files found in {content_dir}")
-        return chars
+        return set(), h.hexdigest()
 
     print(f"  Scanning {len(files)} content files...")
 
-    for filepath in files:
-        with open(filepath, "r", encoding="utf-8") as f:
-            text = f.read()
-        chars.update(text)
+    for filepath, data in zip(files, _read_files(files)):
+        # Paths can't contain NUL; length-prefix the data so file boundaries
+        # are unambiguous and no path/content split can collide
+        h.update(os.path.relpath(filepath, content_dir).encode("utf-8"))
+        h.update(b"\0")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+        # Pure-ASCII files skip the UTF-8 decoder's multi-byte handling
+        chars.update(data.decode("ascii" if data.isascii() else "utf-8"))
 
-    # Add guaranteed characters
-    chars.update(ALWAYS_INCLUDE)
+    # Codepoints from here on; ord() runs once per unique char, not per char
+    cps = set(map(ord, chars))
 
     # Remove control characters (keep only printable)
-    chars = {c for c in chars if ord(c) >= 0x20}
+    cps -= _CONTROL_CPS
+
+    # Add guaranteed characters (already clean)
+    cps |= _ALWAYS_INCLUDE_CPS
 
-    return chars
+    return cps, h.hexdigest()
 
 
-def check_coverage(font_path: str, chars: set[str]) -> tuple[set[str], set[str]]:
-    """Check which chars have real glyphs in the font."""
+# (font path, mtime_ns) → codepoints mapped to a real (non-.notdef) glyph
+_glyph_cps_cache: dict[tuple[str, int], frozenset[int]] = {}
+
+
+def _glyph_cps(font_path: str) -> frozenset[int]:
+    """Codepoints with real glyphs in a font, parsed once per file version."""
+    key = (os.path.abspath(font_path), os.stat(font_path).st_mtime_ns)
+    cached = _glyph_cps_cache.get(key)
+    if cached is not None:
+        return cached
+
     from fontTools.ttLib import TTFont
 
-    font = TTFont(font_path)
+    # Only cmap (and the glyph order it resolves through) is needed
+    font = TTFont(font_path, lazy=True)
     cmap = font.getBestCmap()
     glyph_order = font.getGlyphOrder()
     notdef = glyph_order[0] if glyph_order else '.notdef'
+    font.close()
 
-    covered = set()
-    missing = set()
+    cps = frozenset(cp for cp, glyph in cmap.items()
+                    if glyph != notdef and glyph != '.notdef')
+    _glyph_cps_cache[key] = cps
+    return cps
 
-    for char in chars:
-        cp = ord(char)
-        if cp in cmap and cmap[cp] != notdef and cmap[cp] != '.notdef':
-            covered.add(char)
-        else:
-            missing.add(char)
 
-    font.close()
-    return covered, missing
+def check_coverage(font_path: str, cps: set[int]) -> tuple[set[int], set[int]]:
+    """Check which codepoints have real glyphs in the font."""
+    glyph_cps = _glyph_cps(font_path)
+    return cps & glyph_cps, cps - glyph_cps
+
+
+def _tag(name: str) -> int:
+    """Pack a 4-char OpenType tag into the integer form HarfBuzz sets use."""
+    return int.from_bytes(name.ljust(4).encode("ascii"), "big")
+
+
+def write_woff2(sfnt: bytes, output: str) -> None:
+    """Wrap a plain sfnt as woff2, copying table bytes without a TTFont parse."""
+    from fontTools.ttLib.sfnt import SFNTReader
+    from fontTools.ttLib.woff2 import WOFF2Writer
+
+    reader = SFNTReader(io.BytesIO(sfnt))
+    with open(output, "wb") as f:
+        writer = WOFF2Writer(f, reader.numTables, reader.sfntVersion)
+        for tag in reader.keys():
+            writer[tag] = reader[tag]
+        writer.close()
+
+
+def build_subset_input(cps: set[int]):
+    """Build the hb-subset plan once; it is identical for every weight."""
+    import uharfbuzz as hb
+
+    subset_input = hb.SubsetInput()
+    subset_input.unicode_set.update(cps)
+    # Keep CFF subroutines: desubroutinizing re-expands every charstring,
+    # costs most of the subset time, and brotli recovers the size anyway
+    subset_input.flags = hb.SubsetFlags.NO_HINTING
+    features = subset_input.layout_feature_tag_set
+    features.clear()
+    features.update(map(_tag, SUBSET_LAYOUT_FEATURES))
+    subset_input.drop_table_tag_set.update(map(_tag, SUBSET_DROP_TABLES))
+    return subset_input
+
 
+def plan_digest(cps: set[int]) -> bytes:
+    """Digest of the subset plan: the codepoints plus this script's settings."""
+    h = hashlib.blake2b()
+    with open(__file__, "rb") as f:
+        h.update(f.read())
+    h.update(b"".join(cp.to_bytes(3, "big") for cp in sorted(cps)))
+    return h.digest()
 
-def generate_subset(weight: int, font_file: str, chars: set[str],
-                    output_dir: str) -> int:
-    """Generate a woff2 subset. Returns file size or 0 on failure."""
+
+def generate_subset(weight: int, font_file: str, subset_input,
+                    output_dir: str, digest: bytes) -> int:
+    """Generate a woff2 subset. Returns file size or 0 on failure.
+
+    A key file in CACHE_DIR records the plan digest, source mtime and output
+    path; when it still matches, the existing woff2 is reused without
+    subsetting.
+    """
     source = os.path.join(FONT_DIR, font_file)
     output = os.path.join(output_dir, f"{FAMILY}-{weight}.woff2")
 
@@ -113,28 +245,145 @@ def generate_subset(weight: int, font_file: str, chars: set[str],
         print(f"    Warning: {source} not found, skipping weight {weight}")
         return 0
 
-    from fontTools.subset import Subsetter, Options
-    from fontTools.ttLib import TTFont
-
-    options = Options()
-    options.flavor = "woff2"
-    options.desubroutinize = True
-    # Keep basic layout features for proper rendering
-    options.layout_features = ['kern', 'liga', 'calt', 'ccmp', 'locl']
-    options.drop_tables += ["meta", "MATH"]
-
-    font = TTFont(source)
+    key_path = os.path.join(CACHE_DIR, f"{FAMILY}-{weight}.woff2.key")
+    key = hashlib.blake2b(
+        digest + str(os.stat(source).st_mtime_ns).encode()
+        + os.path.abspath(output).encode("utf-8")).hexdigest()[:16]
+    try:
+        with open(key_path, encoding="utf-8") as f:
+            if f.read().strip() == key and os.path.exists(output):
+                return os.path.getsize(output)
+    except OSError:
+        pass
+
+    import uharfbuzz as hb
+
+    face = hb.Face(hb.Blob.from_file_path(source))
+
+    try:
+        subset = hb.subset(face, subset_input)
+    except RuntimeError:
+        print(f"    Warning: hb-subset failed for {source}, skipping weight {weight}")
+        return 0
 
-    subsetter = Subsetter(options=options)
-    subsetter.populate(unicodes=[ord(c) for c in chars])
-    subsetter.subset(font)
-    font.save(output)
-    font.close()
+    # Invalidate the old key first, and only swap in a fully written woff2,
+    # so an interrupted run can never leave a stale key over a broken file
+    if os.path.exists(key_path):
+        os.remove(key_path)
+    tmp_output = output + ".tmp"
+    try:
+        # hb-subset emits a plain sfnt; fontTools only wraps it as woff2
+        write_woff2(subset.blob.data, tmp_output)
+        os.replace(tmp_output, output)
+    finally:
+        if os.path.exists(tmp_output):
+            os.remove(tmp_output)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(key_path, "w", encoding="utf-8") as f:
+        f.write(key + "\n")
 
     size = os.path.getsize(output)
     return size
 
 
+# Per-process subset plan, built once by _init_worker (hb objects don't pickle)
+_worker_subset_input = None
+_worker_plan_digest = b""
+
+
+def _init_worker(cps: set[int]):
+    global _worker_subset_input, _worker_plan_digest
+    _worker_subset_input = build_subset_input(cps)
+    _worker_plan_digest = plan_digest(cps)
+
+
+def _subset_one(task: tuple[int, str, str]) -> tuple[int, int]:
+    weight, font_file, output_dir = task
+    return weight, generate_subset(weight, font_file, _worker_subset_input,
+                                   output_dir, _worker_plan_digest)
+
+
+def unicode_ranges(cps: set[int]) -> list[str]:
+    """Coalesce codepoints into coarse CSS unicode-range spans.
+
+    Runs separated by at most _RANGE_MAX_GAP unused codepoints are merged, so
+    scattered hanzi collapse into a few spans (U+20-7E, U+4E00-9F8D, ...)
+    instead of thousands of terms. Gap codepoints the subset lacks still fall
+    back per glyph, so the coarser list is harmless.
+    """
+    spans = []
+    for cp in sorted(cps):
+        if spans and cp - spans[-1][1] - 1 <= _RANGE_MAX_GAP:
+            spans[-1][1] = cp
+        else:
+            spans.append([cp, cp])
+    return [f"U+{lo:X}" if lo == hi else f"U+{lo:X}-{hi:X}" for lo, hi in spans]
+
+
+def write_font_face_css(output_dir: str, weights: list[int],
+                        cps: set[int]) -> None:
+    """Write one @font-face rule per weight, each with the subset's unicode-range.
+
+    Every page contains Basic Latin, so this never avoids a download. What
+    the range buys is routing: characters outside it (Nüshu, CJK Ext B,
+    emoji, ...) go straight to the next font in the stack. URLs are relative
+    to the stylesheet, so they resolve to the woff2 files beside it;
+    __FONT_VERSION__ is stamped by server-deploy.sh.
+    """
+    unicode_range = ", ".join(unicode_ranges(cps))
+    with open(os.path.join(output_dir, FONT_FACE_CSS), "w",
+              encoding="utf-8") as f:
+        f.write("/* Generated by scripts/subset-fonts.py — do not edit. */\n")
+        for weight in weights:
+            f.write(
+                "@font-face {\n"
+                f"  font-family: '{FAMILY}';\n"
+                f"  src: url('{FAMILY}-{weight}.woff2?v=__FONT_VERSION__') format('woff2');\n"
+                f"  font-weight: {weight}; font-style: normal; font-display: block;\n"
+                f"  unicode-range: {unicode_range};\n"
+                "}\n")
+
+
+def build_fingerprint(content_hash: str, output_dir: str) -> dict:
+    """Fingerprint everything the output depends on: content, fonts, this script."""
+    with open(__file__, "rb") as f:
+        script_hash = hashlib.blake2b(f.read()).hexdigest()
+
+    font_mtimes = {}
+    for font_file in sorted(set(WEIGHTS.values())):
+        path = os.path.join(FONT_DIR, font_file)
+        font_mtimes[font_file] = (os.stat(path).st_mtime_ns
+                                  if os.path.exists(path) else None)
+
+    return {"output_dir": os.path.abspath(output_dir),
+            "content_hash": content_hash, "script_hash": script_hash,
+            "font_mtimes": font_mtimes}
+
+
+def is_cached(output_dir: str, fingerprint: dict) -> bool:
+    """True if the manifest matches and every file it lists still exists."""
+    try:
+        with open(os.path.join(CACHE_DIR, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if any(manifest.get(k) != v for k, v in fingerprint.items()):
+        return False
+    generated = manifest.get("generated_files") or []
+    return bool(generated) and all(
+        os.path.exists(os.path.join(output_dir, name)) for name in generated)
+
+
+def clean_old_files(output_dir: str) -> None:
+    """Remove font files left over from the previous per-range architecture."""
+    for old_pattern in ["CJKExtB-Serif-*.woff2", "CJKRare-Serif-*.woff2"]:
+        for old_file in glob.glob(os.path.join(output_dir, old_pattern)):
+            os.remove(old_file)
+            print(f"    Cleaned up old file: {os.path.basename(old_file)}")
+
+
 def main():
     if len(sys.argv) != 3:
         print(f"Usage: {sys.argv[0]} <content_dir> <output_dir>")
@@ -153,8 +402,18 @@ def main():
     print("=" * 40)
 
     # Step 1: Scan content
-    all_chars = scan_content(content_dir)
-    print(f"  Total unique characters: {len(all_chars)}")
+    all_cps, content_hash = scan_content(content_dir)
+    print(f"  Total unique characters: {len(all_cps)}")
+
+    # Clean up old files from previous architecture
+    clean_old_files(output_dir)
+
+    # Skip the rest if nothing the output depends on has changed
+    fingerprint = build_fingerprint(content_hash, output_dir)
+    if is_cached(output_dir, fingerprint):
+        print("  Content and source fonts unchanged, using cached subsets.")
+        print("Done.")
+        return
 
     # Step 2: Check coverage against Regular weight
     regular_path = os.path.join(FONT_DIR, WEIGHTS[400])
@@ -162,16 +421,17 @@ def main():
         print(f"  Error: {regular_path} not found!")
         sys.exit(1)
 
-    covered, missing = check_coverage(regular_path, all_chars)
+    covered, missing = check_coverage(regular_path, all_cps)
 
     # Categorize for reporting
-    cjk_covered = {c for c in covered if ord(c) >= 0x4E00}
-    latin_covered = {c for c in covered if ord(c) < 0x4E00}
-    cjk_missing = {c for c in missing if ord(c) >= 0x2000}  # non-trivial missing
+    cjk_covered = {cp for cp in covered if cp >= 0x4E00}
+    latin_covered = {cp for cp in covered if cp < 0x4E00}
+    cjk_missing = {cp for cp in missing if cp >= 0x2000}  # non-trivial missing
 
     print(f"  Covered by font: {len(covered)} ({len(cjk_covered)} CJK + {len(latin_covered)} Latin/symbols)")
     if cjk_missing:
-        miss_display = "".join(sorted(cjk_missing)[:20])
+        # Only the first 20 are shown; don't sort the whole set for them
+        miss_display = "".join(map(chr, heapq.nsmallest(20, cjk_missing)))
         extra = f" (+{len(cjk_missing)-20} more)" if len(cjk_missing) > 20 else ""
         print(f"  CJK chars without glyphs: {len(cjk_missing)} [{miss_display}]{extra}")
         print(f"    (these will fall back to system fonts)")
@@ -179,21 +439,35 @@ def main():
 
     # Step 3: Generate subsets for each weight
     print(f"  Generating {len(WEIGHTS)} weight variants...")
+    # Weights are independent and CPU-bound: one process per weight
+    tasks = [(weight, font_file, output_dir)
+             for weight, font_file in sorted(WEIGHTS.items())]
+    workers = min(len(tasks), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(covered,)) as pool:
+        results = list(pool.map(_subset_one, tasks))
+
     total_size = 0
-    for weight, font_file in sorted(WEIGHTS.items()):
-        size = generate_subset(weight, font_file, covered, output_dir)
+    generated = []
+    generated_weights = []
+    for weight, size in results:
         if size > 0:
             total_size += size
+            generated.append(f"{FAMILY}-{weight}.woff2")
+            generated_weights.append(weight)
             print(f"    {FAMILY}-{weight}.woff2  ({size:,} bytes)")
 
-    # Clean up old files from previous architecture
-    for old_pattern in ["CJKExtB-Serif-*.woff2", "CJKRare-Serif-*.woff2"]:
-        for old_file in glob.glob(os.path.join(output_dir, old_pattern)):
-            os.remove(old_file)
-            print(f"    Cleaned up old file: {os.path.basename(old_file)}")
+    write_font_face_css(output_dir, generated_weights, covered)
+    generated.append(FONT_FACE_CSS)
+    print(f"    {FONT_FACE_CSS}  (@font-face with unicode-range)")
 
     print()
     print(f"  Total font size: {total_size:,} bytes ({total_size/1024:.0f} KB)")
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with open(os.path.join(CACHE_DIR, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({**fingerprint, "generated_files": generated}, f, indent=2)
+        f.write("\n")
     print("Done.")
 
 
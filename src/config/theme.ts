@@ -12,8 +12,9 @@
  */
 
 // ── Font Cache Version ────────────────────────────────────
-// __FONT_VERSION__ placeholders in global.css and BaseLayout.astro
-// are replaced by server-deploy.sh with a Unix timestamp before build.
+// __FONT_VERSION__ placeholders in global.css, BaseLayout.astro and the
+// generated public/fonts/subsets.css are replaced by server-deploy.sh with
+// a Unix timestamp before build.
 // This busts iOS PWA aggressive caching. No manual maintenance needed.
 
 // ── Color Palettes ─────────────────────────────────────────